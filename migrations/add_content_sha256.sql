@@ -0,0 +1,5 @@
+-- Deduplicate inbound notes (e.g. Twilio retries) per user by content hash.
+-- Existing rows keep a NULL hash, which the unique index does not constrain.
+ALTER TABLE user_notes ADD COLUMN IF NOT EXISTS content_sha256 bytea;
+CREATE UNIQUE INDEX IF NOT EXISTS user_notes_username_content_sha256_key
+    ON user_notes (username, content_sha256);
@@ -1,16 +1,56 @@
 import os
 import psycopg2 # For connecting to PostgreSQL/Supabase
+import psycopg2.extras
+import psycopg2.pool
 import json
+import atexit
+import logging
+import logging.handlers
+import threading
+import queue
+import time
 import datetime
+import hashlib
+import fcntl
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
 from flask import Flask, request, jsonify
+from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
-import openai # For OpenAI API calls
+import httpx
+import openai
+from openai import OpenAI # For OpenAI API calls
+import tiktoken
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
+try: # Optional, only needed for the semantic cache
+    import hnswlib
+    from fastembed import TextEmbedding
+except ImportError:
+    hnswlib = None
+    TextEmbedding = None
 
 # Load environment variables from .env file
 load_dotenv()
 
+# --- Logging ---
+# Handler threads only enqueue log records; a single listener thread writes them
+# out, so request threads never contend on the stdout lock.
+logger = logging.getLogger("webhook")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 app = Flask(__name__)
+# Notes are summarized anyway, so there is no point accepting huge payloads
+app.config['MAX_CONTENT_LENGTH'] = 256 * 1024
 
 # --- Supabase Database Credentials ---
 DB_HOST = os.getenv("SUPABASE_DB_HOST")
@@ -21,87 +61,359 @@ DB_PASSWORD = os.getenv("SUPABASE_DB_PASSWORD")
 
 # --- OpenAI API Key ---
 # Ensure this matches the key you put in your .env file
-openai.api_key = os.getenv("OPENAI_API_KEY")
-if not openai.api_key:
-    print("ERROR: OpenAI API key not found in environment variables for webhook_receiver.")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+if not OPENAI_API_KEY:
+    logger.error("OpenAI API key not found in environment variables for webhook_receiver.")
     # In a real production app, you might want to exit or log more severely
     # For now, let it continue but AI calls will fail.
 
+# --- OpenAI Client ---
+# One shared client with a pooled HTTP/2 connection, so calls reuse TLS
+# connections to api.openai.com instead of handshaking each time.
+# The SDK's own retries are disabled: they would bypass the rate limiter, and
+# create_chat_completion already retries 429s.
+client = OpenAI(
+    api_key=OPENAI_API_KEY,
+    max_retries=0,
+    http_client=httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        timeout=30.0
+    )
+)
+
+# --- Twilio REST Credentials (for SMS confirmations) ---
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
+TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
+TWILIO_CLIENT = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN) if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN else None
+
+# Shared worker threads used to overlap independent OpenAI calls
+AI_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="openai")
+
+# --- Database Connection Pool ---
+# Connections are opened once and reused across requests instead of paying the
+# TCP + TLS + auth handshake to Supabase on every webhook.
+DB_POOL_MIN_CONN = 2
+DB_POOL_MAX_CONN = 20
+POOL = None
+_pool_lock = threading.Lock()
+
+def get_connection_pool():
+    """Returns the shared connection pool, creating it on first use."""
+    global POOL
+    if POOL is None:
+        with _pool_lock:
+            if POOL is None:
+                POOL = psycopg2.pool.ThreadedConnectionPool(
+                    DB_POOL_MIN_CONN,
+                    DB_POOL_MAX_CONN,
+                    host=DB_HOST,
+                    port=DB_PORT,
+                    database=DB_NAME,
+                    user=DB_USER,
+                    password=DB_PASSWORD
+                )
+    return POOL
+
+@atexit.register
+def close_connection_pool():
+    if POOL is not None:
+        POOL.closeall()
+
+# Supabase/pgbouncer drop idle connections, and psycopg2 only notices when a
+# query fails. Connections idle longer than this are pinged before being used.
+DB_CONN_IDLE_CHECK_SECONDS = 30
+_connection_last_used = weakref.WeakKeyDictionary()
+
+def is_connection_alive(conn):
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+        return True
+    except psycopg2.Error:
+        return False
+
 # --- Database Connection Function ---
 def get_supabase_connection():
-    """Establishes and returns a connection to the Supabase PostgreSQL database."""
+    """Checks out a live connection to the Supabase PostgreSQL database from the pool."""
     try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        return conn
+        pool = get_connection_pool()
+        # Every idle connection may be dead, so allow for discarding all of them
+        for _ in range(DB_POOL_MAX_CONN + 1):
+            conn = pool.getconn()
+            last_used = _connection_last_used.get(conn)
+            if last_used is None or time.monotonic() - last_used < DB_CONN_IDLE_CHECK_SECONDS:
+                return conn
+            if is_connection_alive(conn):
+                return conn
+            logger.warning("Discarding dead pooled Supabase connection.")
+            pool.putconn(conn, close=True)
+        raise psycopg2.OperationalError("no live connection available")
     except Exception as e:
-        print(f"ERROR: Could not connect to Supabase: {e}")
+        logger.error(f"Could not connect to Supabase: {e}")
         return None
 
-# --- Function to Save Note to Supabase (Unified for all inputs) ---
-# IMPORTANT: 'username' parameter added here
-def save_note_to_database(content, summary, sentiment, keywords, username):
-    """Saves processed note data to the Supabase database."""
+def release_supabase_connection(conn):
+    """Returns a connection to the pool, discarding it if it has been closed."""
+    try:
+        _connection_last_used[conn] = time.monotonic()
+        POOL.putconn(conn, close=bool(conn.closed))
+    except Exception as e:
+        logger.error(f"Could not return connection to pool: {e}")
+
+# --- Batched Note Writer ---
+# Notes are queued and a single writer thread inserts them in batches (up to
+# NOTE_BATCH_MAX_SIZE rows or NOTE_BATCH_MAX_WAIT seconds), one round-trip and
+# one commit per batch instead of per note.
+NOTE_BATCH_MAX_SIZE = 100
+NOTE_BATCH_MAX_WAIT = 0.1
+NOTE_WRITE_QUEUE = queue.Queue()
+_note_writer = None
+_note_writer_lock = threading.Lock()
+
+def start_note_writer():
+    """Starts the background writer thread if it is not already running."""
+    global _note_writer
+    if _note_writer is None:
+        with _note_writer_lock:
+            if _note_writer is None:
+                _note_writer = threading.Thread(target=note_writer_loop, name="note-writer", daemon=True)
+                _note_writer.start()
+
+def note_writer_loop():
+    while True:
+        batch = [NOTE_WRITE_QUEUE.get()]
+        deadline = time.monotonic() + NOTE_BATCH_MAX_WAIT
+        while len(batch) < NOTE_BATCH_MAX_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(NOTE_WRITE_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        inserted_ids = insert_note_rows_safely([row for row, _ in batch])
+        if inserted_ids is None and len(batch) > 1:
+            # One bad row fails the whole transaction, so retry the rows one at a
+            # time and let only the bad one fail.
+            logger.warning(f"Batch of {len(batch)} notes failed, retrying them individually.")
+            inserted_ids = [(insert_note_rows_safely([row]) or [None])[0] for row, _ in batch]
+        for i, (_, future) in enumerate(batch):
+            future.set_result(inserted_ids[i] if inserted_ids else None)
+
+def insert_note_rows_safely(rows):
+    """insert_note_rows that logs unexpected exceptions instead of raising them."""
+    try:
+        return insert_note_rows(rows)
+    except Exception as e: # Never let the writer thread die with callers still waiting
+        logger.exception(f"Note writer failed on a batch of {len(rows)}: {e}")
+        return None
+
+# Single-note batches (the common case outside bursts) use a server-side
+# prepared statement, so Postgres parses and plans the INSERT once per pooled
+# connection instead of on every note.
+PREPARE_INSERT_NOTE = """
+PREPARE ins_note_dedup (text, text, text, text[], text, bytea) AS
+INSERT INTO user_notes (content, summary, sentiment, keywords, username, content_sha256, timestamp)
+VALUES ($1, $2, $3, $4, $5, $6, CURRENT_TIMESTAMP)
+ON CONFLICT (username, content_sha256) DO NOTHING
+RETURNING id, username, content_sha256;
+"""
+EXECUTE_INSERT_NOTE = "EXECUTE ins_note_dedup (%s, %s, %s, %s, %s, %s);"
+_prepared_connections = weakref.WeakSet()
+
+def ensure_insert_prepared(conn, cur):
+    """Prepares the single-note INSERT on this connection if it has not been already."""
+    if conn in _prepared_connections:
+        return
+    cur.execute("SELECT 1 FROM pg_prepared_statements WHERE name = 'ins_note_dedup';")
+    if cur.fetchone() is None:
+        cur.execute(PREPARE_INSERT_NOTE)
+    _prepared_connections.add(conn)
+
+def insert_note_rows(rows, retry_on_dead_connection=True):
+    """Inserts a batch of note rows. Returns the new ids in row order, or None on failure.
+    If the pooled connection turns out to be dead, the insert is retried once on a fresh one."""
     conn = get_supabase_connection()
     if conn is None:
-        return False
+        return None
 
+    retry = False
     try:
-        cur = conn.cursor()
-
-        # Convert Python list of keywords to a PostgreSQL array literal string
-        # This handles keywords with spaces or internal quotes correctly
-        keywords_pg_array = '{' + ','.join([
-            f'"{k.replace("\"", "\\\"")}"' for k in keywords
-        ]) + '}'
-
-        # IMPORTANT: 'username' and 'timestamp' columns included in the INSERT query
+        # IMPORTANT: 'username' and 'timestamp' columns included in the INSERT query.
+        # Duplicates of an existing (username, content) pair are skipped and
+        # resolved to the existing note's id below.
         insert_query = """
-        INSERT INTO user_notes (content, summary, sentiment, keywords, username, timestamp)
-        VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
-        RETURNING id;
+        INSERT INTO user_notes (content, summary, sentiment, keywords, username, content_sha256, timestamp)
+        VALUES %s
+        ON CONFLICT (username, content_sha256) DO NOTHING
+        RETURNING id, username, content_sha256;
         """
-        # IMPORTANT: 'username' value passed as a parameter here
-        cur.execute(insert_query, (content, summary, sentiment, keywords_pg_array, username))
-        inserted_id = cur.fetchone()[0]
-        conn.commit()
-        print(f"--- Note successfully saved to Supabase with ID: {inserted_id} for user: {username} ---")
-        return True
+        # 'with conn' commits on success and rolls back on any exception
+        with conn:
+            with conn.cursor() as cur:
+                # Don't wait for the WAL fsync on commit. A crash can lose the last
+                # few hundred ms of notes, which webhook retries will replay.
+                cur.execute("SET LOCAL synchronous_commit = OFF;")
+                if len(rows) == 1:
+                    ensure_insert_prepared(conn, cur)
+                    cur.execute(EXECUTE_INSERT_NOTE, rows[0])
+                    inserted = cur.fetchall()
+                else:
+                    inserted = psycopg2.extras.execute_values(
+                        cur, insert_query, rows,
+                        template="(%s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP)",
+                        page_size=NOTE_BATCH_MAX_SIZE,
+                        fetch=True
+                    )
+                ids_by_key = {(username, bytes(content_hash)): note_id for note_id, username, content_hash in inserted}
+                for row in rows:
+                    key = (row[4], row[5])
+                    if key not in ids_by_key:
+                        cur.execute(SELECT_EXISTING_NOTE, key)
+                        ids_by_key[key] = cur.fetchone()[0]
+        return [ids_by_key[(row[4], row[5])] for row in rows]
     except psycopg2.Error as db_error: # Catch specific database errors for better debugging
-        conn.rollback()
-        print(f"DATABASE ERROR during save_note_to_database: {db_error.pgcode} - {db_error.pgerror}")
-        return False
+        # Re-check the prepared statement next time in case it did not survive the rollback
+        _prepared_connections.discard(conn)
+        logger.error(f"DATABASE ERROR during insert_note_rows: {db_error}")
+        # A connection dropped by Supabase/pgbouncer is discarded on release
+        retry = (retry_on_dead_connection and bool(conn.closed)
+                 and isinstance(db_error, (psycopg2.OperationalError, psycopg2.InterfaceError)))
+        if not retry:
+            return None
     except Exception as e: # Catch any other Python errors
-        conn.rollback()
-        print(f"OTHER ERROR during save_note_to_database: {e}")
-        return False
+        logger.error(f"OTHER ERROR during insert_note_rows: {e}")
+        return None
     finally:
-        if conn:
-            cur.close()
-            conn.close()
+        release_supabase_connection(conn)
 
-# --- AI Analysis Functions (Using OpenAI) ---
-def get_ai_analysis(text_input, prompt_type):
-    """
-    Generalized function to call OpenAI for various analysis tasks.
-    `prompt_type` can be 'summary', 'sentiment', 'keywords', or 'full_analysis_prompt'.
-    """
-    system_message = "You are a helpful AI assistant."
-    user_prompt = ""
-
-    if prompt_type == 'summary':
-        user_prompt = f"Summarize the following text concisely:\n\n{text_input}"
-    elif prompt_type == 'sentiment':
-        user_prompt = f"What is the sentiment of the following text (positive, negative, neutral)? Just provide the sentiment word.\n\n{text_input}"
-    elif prompt_type == 'keywords':
-        user_prompt = f"Extract 5-10 key keywords from the following text, separated by commas. Only provide the keywords.\n\n{text_input}"
-    elif prompt_type == 'full_analysis_prompt': # This is if you want to use the detailed prompt from app.py
-         user_prompt = f"""
+    logger.warning("Retrying insert_note_rows on a fresh connection.")
+    return insert_note_rows(rows, retry_on_dead_connection=False)
+
+# --- Duplicate Note Detection ---
+# user_notes has a unique index on (username, content_sha256), see
+# migrations/add_content_sha256.sql, so webhook retries never store a note twice.
+SELECT_EXISTING_NOTE = "SELECT id FROM user_notes WHERE username = %s AND content_sha256 = %s;"
+
+def note_content_hash(content):
+    return hashlib.sha256(content.encode()).digest()
+
+def find_existing_note_id(username, content_hash):
+    """Returns the id of an already saved note with the same content for this user, or None."""
+    conn = get_supabase_connection()
+    if conn is None:
+        return None
+
+    try:
+        with conn:
+            with conn.cursor() as cur:
+                cur.execute(SELECT_EXISTING_NOTE, (username, content_hash))
+                row = cur.fetchone()
+        return row[0] if row else None
+    except psycopg2.Error as db_error:
+        logger.error(f"DATABASE ERROR during find_existing_note_id: {db_error}")
+        return None
+    except Exception as e: # Catch any other Python errors
+        logger.error(f"OTHER ERROR during find_existing_note_id: {e}")
+        return None
+    finally:
+        release_supabase_connection(conn)
+
+# --- Function to Save Note to Supabase (Unified for all inputs) ---
+# IMPORTANT: 'username' parameter added here
+def save_note_to_database(content, summary, sentiment, keywords, username, content_hash=None):
+    """Queues processed note data for the batched writer and waits for it to be saved."""
+    if content_hash is None:
+        content_hash = note_content_hash(content)
+    # Postgres returns usernames as str; normalise so the writer can match them up
+    if username is not None:
+        username = str(username)
+    start_note_writer()
+    future = Future()
+    # IMPORTANT: 'username' value passed as part of the row here.
+    # psycopg2 adapts the keywords list to a text[] with proper quoting.
+    NOTE_WRITE_QUEUE.put(((content, summary, sentiment, list(keywords), username, content_hash), future))
+    inserted_id = future.result()
+    if inserted_id is None:
+        return False
+    logger.info(f"--- Note successfully saved to Supabase with ID: {inserted_id} for user: {username} ---")
+    return True
+
+# --- OpenAI Rate Limiting & Retries ---
+# A token bucket keeps us under the account's requests-per-minute limit during
+# bursts, and any 429 or transient error is retried with backoff instead
+# of being saved to the database as an "Error: ..." note.
+# OPENAI_MAX_RPM is the account-wide limit. Each gunicorn worker process has its
+# own bucket, so it gets an equal share based on WEB_CONCURRENCY (the worker
+# count, set in the Procfile).
+OPENAI_MAX_RPM = int(os.getenv("OPENAI_MAX_RPM", "500"))
+WEB_CONCURRENCY = max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+OPENAI_WORKER_RPM = max(OPENAI_MAX_RPM / WEB_CONCURRENCY, 1.0)
+_rate_tokens = OPENAI_WORKER_RPM
+_rate_updated_at = time.monotonic()
+_rate_lock = threading.Lock()
+
+def acquire_openai_slot():
+    """Blocks until the rate limiter allows another OpenAI request."""
+    global _rate_tokens, _rate_updated_at
+    refill_per_second = OPENAI_WORKER_RPM / 60.0
+    while True:
+        with _rate_lock:
+            now = time.monotonic()
+            _rate_tokens = min(OPENAI_WORKER_RPM, _rate_tokens + (now - _rate_updated_at) * refill_per_second)
+            _rate_updated_at = now
+            if _rate_tokens >= 1:
+                _rate_tokens -= 1
+                return
+            wait = (1 - _rate_tokens) / refill_per_second
+        time.sleep(wait)
+
+_exponential_wait = wait_random_exponential(min=1, max=60)
+
+def wait_for_retry_after(retry_state):
+    """Honours OpenAI's Retry-After header when present, otherwise backs off exponentially."""
+    error = retry_state.outcome.exception()
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), 60.0)
+    except (TypeError, ValueError):
+        return _exponential_wait(retry_state)
+
+# Transient failures the SDK itself would otherwise retry (client max_retries=0)
+RETRYABLE_OPENAI_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+@retry(
+    retry=retry_if_exception_type(RETRYABLE_OPENAI_ERRORS),
+    wait=wait_for_retry_after,
+    stop=stop_after_attempt(6),
+    reraise=True
+)
+def create_chat_completion(**kwargs):
+    """Rate-limited chat completion call, retried on 429s, connection errors, timeouts and 5xx."""
+    acquire_openai_slot()
+    return client.chat.completions.create(**kwargs)
+
+# --- Prompt Templates ---
+# Built once at import; each template has a single {} placeholder for the note text.
+SYSTEM_MSG = {"role": "system", "content": "You are a helpful AI assistant."}
+
+PROMPTS = {
+    'summary': "Summarize the following text concisely:\n\n{}",
+    'sentiment': "What is the sentiment of the following text (positive, negative, neutral)? Just provide the sentiment word.\n\n{}",
+    'keywords': "Extract 5-10 key keywords from the following text, separated by commas. Only provide the keywords.\n\n{}",
+    # One round-trip for summary, sentiment and keywords
+    'combined_json': "Return a JSON object with keys 'summary' (string), 'sentiment' (one of positive/negative/neutral), and 'keywords' (array of 5-10 strings) for the following text:\n\n{}",
+    # This is if you want to use the detailed prompt from app.py
+    'full_analysis_prompt': """
 You are an expert knowledge curator and cognitive cartographer, helping individuals map their learning journey.
 Your task is to analyze the following unstructured text, which describes a user's recent learning, consumption, or project experiences.
 From this text, you need to extract and categorize the following key elements of their knowledge landscape:
@@ -120,143 +432,537 @@ From this text, you need to extract and categorize the following key elements of
 
 ---
 User's Learning Content to Analyze:
-"{text_input}"
+"{}"
 ---
-"""
+""",
+}
+
+# Output-token caps per prompt type; OpenAI latency grows with tokens generated,
+# so short answers (a sentiment word, a keyword list) get tight limits.
+MAX_TOKENS = {
+    'summary': 200,
+    'sentiment': 8,
+    'keywords': 80,
+    'combined_json': 350,
+    'full_analysis_prompt': 700,
+}
+
+# --- Input Token Budget ---
+# Long inputs (mostly full-article web clips) are cut to a token budget before
+# being sent, since the note ends up summarized to a few hundred tokens anyway.
+INPUT_TOKEN_BUDGET = 3000
+MAX_SUMMARY_CHUNKS = 8
+APPROX_CHARS_PER_TOKEN = 4 # Used only if the tiktoken encoding can't be loaded
+_encoder = None
+_encoder_loaded = False
+_encoder_lock = threading.Lock()
+
+def get_token_encoder():
+    """Returns the gpt-3.5-turbo tiktoken encoding, or None if it could not be loaded.
+    Loaded on first use because tiktoken downloads the encoding file."""
+    global _encoder, _encoder_loaded
+    if not _encoder_loaded:
+        with _encoder_lock:
+            if not _encoder_loaded:
+                try:
+                    _encoder = tiktoken.encoding_for_model("gpt-3.5-turbo")
+                except Exception as e:
+                    logger.error(f"Could not load tiktoken encoding, approximating tokens by characters: {e}")
+                _encoder_loaded = True
+    return _encoder
+
+def encode_tokens(text_input):
+    """Returns the token ids of a text, or None if the encoder is unavailable."""
+    encoder = get_token_encoder()
+    return encoder.encode(text_input) if encoder is not None else None
+
+def count_tokens(text_input, token_ids):
+    if token_ids is None:
+        return len(text_input) // APPROX_CHARS_PER_TOKEN
+    return len(token_ids)
+
+def split_into_token_chunks(text_input, max_tokens=INPUT_TOKEN_BUDGET, token_ids=None):
+    """Splits a text into chunks of at most `max_tokens`. Pass `token_ids` if already encoded."""
+    if token_ids is None:
+        token_ids = encode_tokens(text_input)
+    if token_ids is None:
+        max_chars = max_tokens * APPROX_CHARS_PER_TOKEN
+        return [text_input[i:i + max_chars] for i in range(0, len(text_input), max_chars)] or [text_input]
+    if len(token_ids) <= max_tokens:
+        return [text_input]
+    encoder = get_token_encoder()
+    return [encoder.decode(token_ids[i:i + max_tokens]) for i in range(0, len(token_ids), max_tokens)]
+
+def truncate_to_token_budget(text_input, max_tokens=INPUT_TOKEN_BUDGET):
+    token_ids = encode_tokens(text_input)
+    if token_ids is None:
+        return text_input[:max_tokens * APPROX_CHARS_PER_TOKEN]
+    if len(token_ids) <= max_tokens:
+        return text_input
+    return get_token_encoder().decode(token_ids[:max_tokens])
+
+# --- AI Response Cache ---
+# Identical (prompt_type, text) pairs are common (forwarded emails, Twilio retries,
+# re-clipped pages), so successful OpenAI replies are kept in a small in-process LRU.
+AI_CACHE_MAX_ENTRIES = 4096
+_ai_cache = OrderedDict()
+_ai_cache_lock = threading.Lock()
+
+def ai_cache_key(text_input, prompt_type):
+    return hashlib.sha256(f"{prompt_type}\0{text_input}".encode()).hexdigest()
+
+def get_cached_ai_analysis(key):
+    with _ai_cache_lock:
+        if key not in _ai_cache:
+            return None
+        _ai_cache.move_to_end(key)
+        return _ai_cache[key]
+
+def store_ai_analysis(key, result):
+    with _ai_cache_lock:
+        _ai_cache[key] = result
+        _ai_cache.move_to_end(key)
+        if len(_ai_cache) > AI_CACHE_MAX_ENTRIES:
+            _ai_cache.popitem(last=False)
+
+# --- Single-Flight Coalescing ---
+# When duplicate webhooks arrive while the first is still waiting on OpenAI,
+# later callers wait on the first call's Future instead of issuing their own.
+INFLIGHT = {}
+_inflight_lock = threading.Lock()
+
+# --- AI Analysis Functions (Using OpenAI) ---
+def get_ai_analysis(text_input, prompt_type, within_budget=False):
+    """
+    Generalized function to call OpenAI for various analysis tasks.
+    `prompt_type` can be 'summary', 'sentiment', 'keywords', 'combined_json', or 'full_analysis_prompt'.
+    For 'combined_json' the parsed dict with 'summary', 'sentiment' and 'keywords' is returned.
+    Successful results are cached, so repeated inputs skip the API call, and
+    concurrent identical requests share a single in-flight call.
+    Inputs longer than INPUT_TOKEN_BUDGET tokens are truncated, unless the caller
+    passes `within_budget=True` because it has already split the text.
+    """
+    if not within_budget:
+        text_input = truncate_to_token_budget(text_input)
+    key = ai_cache_key(text_input, prompt_type)
+    cached = get_cached_ai_analysis(key)
+    if cached is not None:
+        return cached
+
+    with _inflight_lock:
+        # A leader may have stored its result and left INFLIGHT since the check above
+        cached = get_cached_ai_analysis(key)
+        if cached is not None:
+            return cached
+        future = INFLIGHT.get(key)
+        is_leader = future is None
+        if is_leader:
+            future = Future()
+            INFLIGHT[key] = future
+    if not is_leader:
+        return future.result()
+
+    result = None
+    try:
+        result = request_ai_analysis(text_input, prompt_type)
+        # Never cache failures ("Error: ..." strings or unparseable JSON)
+        if result is not None and not is_ai_error(result):
+            store_ai_analysis(key, result)
+    finally:
+        future.set_result(result)
+        with _inflight_lock:
+            INFLIGHT.pop(key, None)
+    return result
 
+def request_ai_analysis(text_input, prompt_type):
+    """Calls OpenAI for a single analysis, bypassing the cache."""
+    user_prompt = PROMPTS[prompt_type].format(text_input)
+
+    # Ask for a JSON object back when we need to parse the reply
+    extra_args = {}
+    if prompt_type == 'combined_json':
+        extra_args['response_format'] = {"type": "json_object"}
 
     try:
-        response = openai.chat.completions.create(
+        response = create_chat_completion(
             model="gpt-3.5-turbo", # Use the model you prefer
             messages=[
-                {"role": "system", "content": system_message},
+                SYSTEM_MSG,
                 {"role": "user", "content": user_prompt}
             ],
             temperature=0.7,
-            max_tokens=500
+            max_tokens=MAX_TOKENS[prompt_type],
+            **extra_args
         )
-        return response.choices[0].message.content.strip()
+        content = response.choices[0].message.content.strip()
+        if prompt_type == 'combined_json':
+            try:
+                parsed = json.loads(content)
+            except json.JSONDecodeError as decode_error:
+                logger.error(f"Could not parse JSON from OpenAI for '{prompt_type}': {decode_error}")
+                return None
+            if not isinstance(parsed, dict):
+                logger.error(f"OpenAI returned JSON that is not an object for '{prompt_type}'.")
+                return None
+            return parsed
+        return content
     except Exception as e:
-        print(f"Error during OpenAI API call for '{prompt_type}': {e}")
+        logger.error(f"Error during OpenAI API call for '{prompt_type}': {e}")
         return f"Error: {str(e)}"
 
+def is_ai_error(result):
+    """True for the "Error: ..." strings request_ai_analysis returns on failure."""
+    return isinstance(result, str) and result.startswith("Error:")
+
 # --- Helper to parse keywords from AI response (if needed) ---
 def parse_keywords_response(response_text):
     # If the AI gives "keyword1, keyword2, keyword3"
     keywords = [k.strip() for k in response_text.split(',') if k.strip()]
     return keywords
 
+# --- Fallback: the three individual prompts, fired concurrently ---
+def analyze_note_separately(text_input):
+    """Returns (summary, sentiment, keywords) using one OpenAI call per field, run in parallel.
+    `text_input` must already be within INPUT_TOKEN_BUDGET."""
+    summary_future = AI_EXECUTOR.submit(get_ai_analysis, text_input, 'summary', True)
+    sentiment_future = AI_EXECUTOR.submit(get_ai_analysis, text_input, 'sentiment', True)
+    keywords_future = AI_EXECUTOR.submit(get_ai_analysis, text_input, 'keywords', True)
+    results = [summary_future.result(), sentiment_future.result(), keywords_future.result()]
+    if any(is_ai_error(result) for result in results):
+        return None
+    summary, sentiment, raw_keywords_response = results
+    return summary, sentiment, parse_keywords_response(raw_keywords_response)
+
+# --- Semantic Cache (optional) ---
+# Near-duplicate notes (re-clipped articles, paraphrased reminders) reuse the
+# analysis of a previously seen note from the same user whose embedding is
+# similar enough, skipping OpenAI entirely. Needs `fastembed` and `hnswlib`
+# and SEMANTIC_CACHE_ENABLED=1.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "").lower() in ("1", "true", "yes")
+if SEMANTIC_CACHE_ENABLED and (hnswlib is None or TextEmbedding is None):
+    logger.warning("SEMANTIC_CACHE_ENABLED is set but fastembed/hnswlib are not installed. Semantic cache disabled.")
+    SEMANTIC_CACHE_ENABLED = False
+SEMANTIC_CACHE_PATH = os.getenv("SEMANTIC_CACHE_PATH", "semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.98
+SEMANTIC_CACHE_DIM = 384 # BAAI/bge-small-en-v1.5
+SEMANTIC_CACHE_SAVE_EVERY = 50
+# Short notes differ in the details that matter ("call mom at 5" vs "call dad
+# at 6"), and the model only embeds the first ~512 tokens, so long notes that
+# share a prefix would collide. Only notes in between use the cache.
+SEMANTIC_CACHE_MIN_WORDS = 20
+SEMANTIC_CACHE_MAX_TOKENS = 512
+_embedding_model = None
+_semantic_index = None
+_semantic_results = [] # label -> [username, summary, sentiment, keywords]
+_semantic_user_counts = Counter()
+_semantic_unsaved = 0
+_semantic_owner_lock_file = None
+_semantic_lock = threading.Lock()
+
+def is_semantic_cache_eligible(text_input, token_ids):
+    if len(text_input.split()) < SEMANTIC_CACHE_MIN_WORDS:
+        return False
+    return count_tokens(text_input, token_ids) <= SEMANTIC_CACHE_MAX_TOKENS
+
+def embed_text(text_input):
+    """Returns the embedding of a note using the local fastembed model."""
+    global _embedding_model
+    with _semantic_lock:
+        if _embedding_model is None:
+            _embedding_model = TextEmbedding("BAAI/bge-small-en-v1.5")
+        model = _embedding_model
+    return next(iter(model.embed([text_input])))
+
+def load_semantic_index():
+    """Loads the index and its stored analyses from disk, or starts an empty one. Call with the lock held."""
+    global _semantic_index, _semantic_results, _semantic_user_counts
+    index = hnswlib.Index(space='cosine', dim=SEMANTIC_CACHE_DIM)
+    try:
+        with open(f"{SEMANTIC_CACHE_PATH}.json") as f:
+            results = json.load(f)
+        index.load_index(f"{SEMANTIC_CACHE_PATH}.bin", max_elements=max(len(results), 1024))
+        if index.get_current_count() != len(results):
+            raise ValueError("semantic cache index and analyses are out of sync")
+    except (OSError, RuntimeError, ValueError) as e:
+        if not isinstance(e, FileNotFoundError):
+            logger.warning(f"Starting with an empty semantic cache: {e}")
+        results = []
+        index = hnswlib.Index(space='cosine', dim=SEMANTIC_CACHE_DIM)
+        index.init_index(max_elements=1024, ef_construction=200, M=16)
+    _semantic_index = index
+    _semantic_results = results
+    _semantic_user_counts = Counter(entry[0] for entry in results)
+
+def is_semantic_cache_owner():
+    """Only one process (the first to lock the owner file) writes the cache files,
+    so gunicorn workers don't overwrite each other's saves. Call with the lock held."""
+    global _semantic_owner_lock_file
+    if _semantic_owner_lock_file is None:
+        lock_file = open(f"{SEMANTIC_CACHE_PATH}.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        _semantic_owner_lock_file = lock_file
+    return True
+
+def save_semantic_index():
+    """Atomically writes the index and its stored analyses to disk. Call with the lock held."""
+    global _semantic_unsaved
+    if _semantic_index is None or not is_semantic_cache_owner():
+        return
+    _semantic_index.save_index(f"{SEMANTIC_CACHE_PATH}.bin.tmp")
+    with open(f"{SEMANTIC_CACHE_PATH}.json.tmp", "w") as f:
+        json.dump(_semantic_results, f)
+    # A crash between the two renames leaves them out of sync, which
+    # load_semantic_index detects by comparing their sizes.
+    os.replace(f"{SEMANTIC_CACHE_PATH}.bin.tmp", f"{SEMANTIC_CACHE_PATH}.bin")
+    os.replace(f"{SEMANTIC_CACHE_PATH}.json.tmp", f"{SEMANTIC_CACHE_PATH}.json")
+    _semantic_unsaved = 0
+
+def find_similar_analysis(embedding, username):
+    """Returns (summary, sentiment, keywords) of this user's closest stored note if it is similar enough."""
+    with _semantic_lock:
+        if _semantic_index is None:
+            load_semantic_index()
+        if not _semantic_user_counts[username]:
+            return None
+        labels, distances = _semantic_index.knn_query(
+            embedding, k=1, filter=lambda label: _semantic_results[label][0] == username
+        )
+        if 1 - distances[0][0] < SEMANTIC_CACHE_THRESHOLD:
+            return None
+        _, summary, sentiment, keywords = _semantic_results[labels[0][0]]
+        return summary, sentiment, list(keywords)
+
+def remember_analysis(embedding, username, summary, sentiment, keywords):
+    """Adds a note's analysis to the semantic cache."""
+    global _semantic_unsaved
+    with _semantic_lock:
+        if _semantic_index is None:
+            load_semantic_index()
+        label = len(_semantic_results)
+        if label >= _semantic_index.get_max_elements():
+            _semantic_index.resize_index(label * 2)
+        _semantic_index.add_items([embedding], [label])
+        _semantic_results.append([username, summary, sentiment, keywords])
+        _semantic_user_counts[username] += 1
+        _semantic_unsaved += 1
+        if _semantic_unsaved >= SEMANTIC_CACHE_SAVE_EVERY:
+            save_semantic_index()
+
+@atexit.register
+def flush_semantic_index():
+    if SEMANTIC_CACHE_ENABLED:
+        with _semantic_lock:
+            save_semantic_index()
+
+# --- Helper to run the analysis, consulting the semantic cache first ---
+def analyze_note(text_input, username):
+    """Returns (summary, sentiment, keywords) for a note, reusing a near-duplicate's analysis if available.
+    Returns None if the analysis failed."""
+    # Tokenized once here and shared with the eligibility check and chunking
+    token_ids = encode_tokens(text_input)
+    if not (SEMANTIC_CACHE_ENABLED and is_semantic_cache_eligible(text_input, token_ids)):
+        return analyze_note_with_openai(text_input, token_ids)
+
+    try:
+        embedding = embed_text(text_input)
+        cached = find_similar_analysis(embedding, username)
+    except Exception as e:
+        logger.error(f"Semantic cache lookup failed: {e}")
+        return analyze_note_with_openai(text_input, token_ids)
+    if cached is not None:
+        logger.info("--- Reusing analysis of a similar note from the semantic cache ---")
+        return cached
+
+    analysis = analyze_note_with_openai(text_input, token_ids)
+    if analysis is not None:
+        try:
+            remember_analysis(embedding, username, *analysis)
+        except Exception as e:
+            logger.error(f"Could not update semantic cache: {e}")
+    return analysis
+
+# --- Helper to run the combined analysis and unpack it ---
+def analyze_note_with_openai(text_input, token_ids=None):
+    """Returns (summary, sentiment, keywords) for a note using a single OpenAI call, or None on failure.
+    Notes over the token budget are first summarized chunk by chunk (map-reduce).
+    Pass `token_ids` if the note has already been encoded."""
+    # The chunks are within budget, so get_ai_analysis doesn't need to re-encode them
+    chunks = split_into_token_chunks(text_input, token_ids=token_ids)
+    if len(chunks) > 1:
+        if len(chunks) > MAX_SUMMARY_CHUNKS:
+            logger.warning(f"Note has {len(chunks)} chunks of {INPUT_TOKEN_BUDGET} tokens, only analysing the first {MAX_SUMMARY_CHUNKS}.")
+        chunk_summaries = list(AI_EXECUTOR.map(
+            lambda chunk: get_ai_analysis(chunk, 'summary', within_budget=True), chunks[:MAX_SUMMARY_CHUNKS]
+        ))
+        if any(is_ai_error(chunk_summary) for chunk_summary in chunk_summaries):
+            return None
+        # At most MAX_SUMMARY_CHUNKS x MAX_TOKENS['summary'] tokens, well within budget
+        text_input = "\n\n".join(chunk_summaries)
+    else:
+        text_input = chunks[0]
+
+    result = get_ai_analysis(text_input, 'combined_json', within_budget=True)
+    if result is None: # Unparseable JSON, fall back to the individual prompts
+        return analyze_note_separately(text_input)
+    if is_ai_error(result): # Don't save "Error: ..." as the note's analysis
+        return None
+    keywords = result.get('keywords') or []
+    if isinstance(keywords, str): # Model occasionally returns "a, b, c" instead of an array
+        keywords = parse_keywords_response(keywords)
+    elif not isinstance(keywords, list):
+        keywords = []
+    summary = str(result.get('summary') or '')
+    sentiment = str(result.get('sentiment') or '')
+    return summary, sentiment, [k.strip() for k in keywords if isinstance(k, str) and k.strip()]
+
+# --- Background Note Processing ---
+# Webhooks are acknowledged immediately and the AI analysis + database save run
+# here, so Twilio/Mailgun never time out and retry while OpenAI is slow.
+NOTE_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="note")
+
+def process_note(content, username):
+    """Runs AI analysis on a note and saves it. Returns True if the note was saved."""
+    try:
+        # A retried delivery of a note we already saved needs no AI work at all
+        content_hash = note_content_hash(content)
+        existing_id = find_existing_note_id(username, content_hash)
+        if existing_id is not None:
+            logger.info(f"--- Duplicate note for user {username}, already saved with ID: {existing_id} ---")
+            return True
+
+        analysis = analyze_note(content, username)
+        if analysis is None:
+            logger.error(f"AI analysis failed for user {username}, note not saved.")
+            return False
+        summary, sentiment, keywords = analysis
+        return save_note_to_database(content, summary, sentiment, keywords, username, content_hash)
+    except Exception as e:
+        logger.error(f"Could not process note for user {username}: {e}")
+        return False
+
+def process_sms_note(message_body, sender_number, twilio_number):
+    """Processes an SMS note in the background and texts the sender the outcome."""
+    if process_note(message_body, sender_number):
+        response_msg = "Your SMS note has been processed and saved to Micro-Atlas! 🧠"
+        logger.info(response_msg)
+    else:
+        logger.error("Failed to save SMS to Supabase.")
+        response_msg = "Failed to process your SMS note. Please try again."
+    send_sms(sender_number, twilio_number, response_msg)
+
+def send_sms(to_number, from_number, body):
+    """Sends an SMS through the Twilio REST API."""
+    if TWILIO_CLIENT is None or not from_number:
+        logger.warning("Twilio credentials not configured, skipping SMS confirmation.")
+        return
+    try:
+        TWILIO_CLIENT.messages.create(to=to_number, from_=from_number, body=body)
+    except Exception as e:
+        logger.error(f"Could not send SMS confirmation to {to_number}: {e}")
+
 # --- Webhook Routes (Modified to include AI analysis and Supabase save) ---
 
+@app.before_request
+def reject_oversized_payloads():
+    """Rejects bodies over MAX_CONTENT_LENGTH before any parsing, AI or DB work."""
+    if request.content_length is not None and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        logger.error(f"Rejected {request.content_length}-byte payload on {request.path}.")
+        return jsonify({"error": "Payload too large"}), 413
+
 @app.route("/sms", methods=['POST'])
 def sms_webhook():
     sender_number = request.form.get('From', 'Unknown')
+    twilio_number = request.form.get('To')
     message_body = request.form.get('Body', '')
-    print(f"\n--- New SMS Received from {sender_number} ---")
-    print(f"Body: {message_body[:100]}...")
-
     if not message_body.strip():
-        print("Empty SMS body received.")
+        logger.warning("Empty SMS body received.")
         return jsonify({"status": "error", "message": "Empty SMS body"}), 400
 
-    # Perform AI analysis
-    summary = get_ai_analysis(message_body, 'summary')
-    sentiment = get_ai_analysis(message_body, 'sentiment')
-    raw_keywords_response = get_ai_analysis(message_body, 'keywords')
-    keywords = parse_keywords_response(raw_keywords_response)
+    logger.info(f"--- New SMS Received from {sender_number} ---")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Body: {message_body[:100]}...")
 
-    # Use the sender_number as the username for this note
-    username_for_note = sender_number
-
-    # IMPORTANT: Passed username_for_note to save_note_to_database
-    if save_note_to_database(message_body, summary, sentiment, keywords, username_for_note):
-        response_msg = "Your SMS note has been processed and saved to Micro-Atlas! 🧠"
-        print(response_msg)
-        twilio_response = MessagingResponse()
-        twilio_response.message(response_msg)
-        return str(twilio_response), 200
-    else:
-        print("Failed to save SMS to Supabase.")
-        twilio_response = MessagingResponse()
-        twilio_response.message("Failed to process your SMS note. Please try again.")
-        return str(twilio_response), 500
+    # Use the sender_number as the username for this note. The confirmation
+    # text is sent from the background job once the note has been saved.
+    NOTE_EXECUTOR.submit(process_sms_note, message_body, sender_number, twilio_number)
+    return str(MessagingResponse()), 200
 
 
 @app.route("/web_clip", methods=['POST'])
 def web_clip_webhook():
-    print(f"\n--- Incoming Web Clip Request Received! ---")
     if not request.is_json:
-        print("ERROR: Web clip request did not contain JSON data.")
+        logger.error("Web clip request did not contain JSON data.")
         return jsonify({"error": "Request must be JSON"}), 400
 
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        logger.error("Web clip request body is not a JSON object.")
+        return jsonify({"error": "Request body must be a JSON object"}), 400
+
     clipped_url = data.get('url')
     clipped_text = data.get('text')
+    if not clipped_url or not isinstance(clipped_text, str) or not clipped_text.strip():
+        logger.error("Missing 'url' or 'text' in web clip data.")
+        return jsonify({"error": "Missing 'url' or 'text' in request body"}), 400
+
     username_for_note = data.get('username') # IMPORTANT: Extract username from JSON payload
+    if username_for_note is not None and not isinstance(username_for_note, str):
+        logger.error("Non-string 'username' in web clip data.")
+        return jsonify({"error": "'username' must be a string"}), 400
+
+    logger.info("--- Incoming Web Clip Request Received! ---")
 
     # Optional: Add robustness if username might be missing from payload
     if not username_for_note:
-        print("WARNING: 'username' not provided in web clip data. Using 'unknown_web_clipper' as default.")
+        logger.warning("'username' not provided in web clip data. Using 'unknown_web_clipper' as default.")
         username_for_note = 'unknown_web_clipper'
 
-
-    if not clipped_url or not clipped_text.strip():
-        print("ERROR: Missing 'url' or 'text' in web clip data.")
-        return jsonify({"error": "Missing 'url' or 'text' in request body"}), 400
-
     full_content = f"Web Clip from {clipped_url}:\n\n{clipped_text}"
-    print(f"Clipped URL: {clipped_url}")
-    print(f"Clipped Text (first 100 chars): {clipped_text[:100]}...")
-
-    # Perform AI analysis
-    summary = get_ai_analysis(full_content, 'summary')
-    sentiment = get_ai_analysis(full_content, 'sentiment')
-    raw_keywords_response = get_ai_analysis(full_content, 'keywords')
-    keywords = parse_keywords_response(raw_keywords_response)
-
-    # IMPORTANT: Passed username_for_note to save_note_to_database
-    if save_note_to_database(full_content, summary, sentiment, keywords, username_for_note):
-        print("Web clip successfully processed and saved to Supabase.")
-        return jsonify({"message": "Web clip received and saved!"}), 200
-    else:
-        print("Failed to save web clip to Supabase.")
-        return jsonify({"error": "Failed to save web clip"}), 500
+    logger.info(f"Clipped URL: {clipped_url}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Clipped Text (first 100 chars): {clipped_text[:100]}...")
+
+    # AI analysis and save happen in the background
+    NOTE_EXECUTOR.submit(process_note, full_content, username_for_note)
+    return jsonify({"message": "Web clip received and queued for processing!"}), 202
 
 
 @app.route('/email_inbound', methods=['POST'])
 def receive_email():
-    print(f"\n--- New Email Received ---")
     # For Mailgun (common fields):
     sender = request.form.get('sender')
     subject = request.form.get('subject')
     body_plain = request.form.get('body-plain')
 
-    if not body_plain.strip():
-        print("ERROR: Received email without plain text body.")
+    if not (body_plain and body_plain.strip()):
+        logger.error("Received email without plain text body.")
         return "Missing email body", 400
 
+    # A NULL username would bypass the (username, content_sha256) dedup index
+    if not sender:
+        logger.warning("'sender' not provided in email data. Using 'unknown_email_sender' as default.")
+        sender = 'unknown_email_sender'
+
+    logger.info("--- New Email Received ---")
+
     # Combine subject and body for AI analysis and storage
     full_content = f"Subject: {subject}\n\n{body_plain}" if subject else body_plain
 
-    print(f"From: {sender}")
-    print(f"Subject: {subject}")
-    print(f"Body (first 100 chars): {body_plain[:100]}...")
+    logger.info(f"From: {sender}")
+    logger.info(f"Subject: {subject}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Body (first 100 chars): {body_plain[:100]}...")
 
-    # Perform AI analysis
-    summary = get_ai_analysis(full_content, 'summary')
-    sentiment = get_ai_analysis(full_content, 'sentiment')
-    raw_keywords_response = get_ai_analysis(full_content, 'keywords')
-    keywords = parse_keywords_response(raw_keywords_response)
-
-    # IMPORTANT: Passed sender to save_note_to_database
-    if save_note_to_database(full_content, summary, sentiment, keywords, sender):
-        print("Email successfully processed and saved to Supabase.")
-        return "Email received and saved!", 200
-    else:
-        print("Failed to save email to Supabase.")
-        return "Error saving email", 500
+    # AI analysis and save happen in the background
+    NOTE_EXECUTOR.submit(process_note, full_content, sender)
+    return "Email received and queued for processing!", 202
 
 # This block allows us to run the server directly from the command line
+# For production, run under gunicorn (see Procfile) rather than the dev server.
 if __name__ == "__main__":
-    print("Starting Flask server on http://localhost:5001")
-    app.run(port=5001, debug=True)
+    logger.info("Starting Flask server on http://localhost:5001")
+    app.run(port=5001, debug=os.getenv("FLASK_DEBUG") == "1", threaded=True)